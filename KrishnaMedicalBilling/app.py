@@ -3,6 +3,8 @@ import csv
 import os
 from datetime import datetime
 
+import replication
+
 app = Flask(__name__)
 
 # Configuration
@@ -13,6 +15,10 @@ INVOICE_DIR = os.path.join(BASE_DIR, 'invoices')
 # Ensure invoice directory exists
 os.makedirs(INVOICE_DIR, exist_ok=True)
 
+# Seed the replication log before any request touches the CSVs, otherwise the
+# first sale would be counted in the seed snapshot and again in its own entry
+replication.init()
+
 @app.route('/')
 def index():
     """Serve the main billing page."""
@@ -118,6 +124,7 @@ def create_invoice():
         total_amount += net_amount
         
         invoice_items.append({
+            'id': pid,
             'name': prod['name'],
             'qty': qty,
             'mrp': mrp,
@@ -143,48 +150,49 @@ def create_invoice():
     lines.append("------------------------------------------------")
 
     # --- SAVE CUSTOMER LOGIC ---
-    try:
-        customers = []
-        if os.path.exists(CUSTOMER_FILE):
-            with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
-                customers = list(csv.DictReader(f))
+    with replication.lock:
+        try:
+            customers = []
+            if os.path.exists(CUSTOMER_FILE):
+                with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
+                    customers = list(csv.DictReader(f))
         
-        # Check if exists (match by Mobile if present, else Name)
-        existing_cust = None
-        if customer_mobile:
-             existing_cust = next((c for c in customers if c.get('mobile') == customer_mobile), None)
+            # Check if exists (match by Mobile if present, else Name)
+            existing_cust = None
+            if customer_mobile:
+                 existing_cust = next((c for c in customers if c.get('mobile') == customer_mobile), None)
         
-        if not existing_cust:
-             existing_cust = next((c for c in customers if c['name'].lower() == customer_name.lower()), None)
-
-        if existing_cust:
-            # Update existing
-            existing_cust['visits'] = str(int(existing_cust.get('visits', 0)) + 1)
-            existing_cust['total_spent'] = str(float(existing_cust.get('total_spent', 0)) + total_amount)
-            if customer_mobile and not existing_cust.get('mobile'):
-                existing_cust['mobile'] = customer_mobile # Update mobile if missing
-        else:
-            # Create new
-            new_id = str(len(customers) + 1)
-            customers.append({
-                'id': new_id,
-                'name': customer_name,
-                'mobile': customer_mobile,
-                'address': '',
-                'visits': '1',
-                'total_spent': str(total_amount)
-            })
-
-        # Write back
-        cust_fieldnames = ['id', 'name', 'mobile', 'address', 'visits', 'total_spent']
-        with open(CUSTOMER_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=cust_fieldnames)
-            writer.writeheader()
-            writer.writerows(customers)
+            if not existing_cust:
+                 existing_cust = next((c for c in customers if c['name'].lower() == customer_name.lower()), None)
+
+            if existing_cust:
+                # Update existing
+                existing_cust['visits'] = str(int(existing_cust.get('visits', 0)) + 1)
+                existing_cust['total_spent'] = str(float(existing_cust.get('total_spent', 0)) + total_amount)
+                if customer_mobile and not existing_cust.get('mobile'):
+                    existing_cust['mobile'] = customer_mobile # Update mobile if missing
+            else:
+                # Create new
+                new_id = str(len(customers) + 1)
+                customers.append({
+                    'id': new_id,
+                    'name': customer_name,
+                    'mobile': customer_mobile,
+                    'address': '',
+                    'visits': '1',
+                    'total_spent': str(total_amount)
+                })
+
+            # Write back
+            cust_fieldnames = ['id', 'name', 'mobile', 'address', 'visits', 'total_spent']
+            with open(CUSTOMER_FILE, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=cust_fieldnames)
+                writer.writeheader()
+                writer.writerows(customers)
 
-    except Exception as e:
-        print(f"Error saving customer: {e}")
-        # Don't fail the invoice for this, just log it
+        except Exception as e:
+            print(f"Error saving customer: {e}")
+            # Don't fail the invoice for this, just log it
     # ---------------------------
     lines.append(f"{'Item':<15} {'Qty':<4} {'MRP':<7} {'Rate':<7} {'Total':<8}")
     lines.append("------------------------------------------------")
@@ -211,33 +219,47 @@ def create_invoice():
     filename = f"{safe_name}_{timestamp}.txt"
     filepath = os.path.join(INVOICE_DIR, filename)
 
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write("\n".join(lines))
+    with replication.lock:
+        try:
+            with open(filepath, 'w', encoding='utf-8') as f:
+                f.write("\n".join(lines))
             
-        # 4. Commit Stock Update to CSV
-        with open(PRODUCT_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(all_products)
+            # 4. Commit Stock Update to CSV
+            with open(PRODUCT_FILE, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(all_products)
             
-        # 5. Log Sale
-        sales_file = os.path.join(BASE_DIR, 'sales.csv')
-        file_exists = os.path.exists(sales_file)
-        with open(sales_file, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(['date', 'time', 'customer', 'amount', 'invoice'])
-            writer.writerow([
-                now.strftime('%Y-%m-%d'), 
-                now.strftime('%H:%M:%S'), 
-                customer_name, 
-                total_amount, 
-                filename
-            ])
+            # 5. Log Sale
+            sales_file = os.path.join(BASE_DIR, 'sales.csv')
+            file_exists = os.path.exists(sales_file)
+            with open(sales_file, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                if not file_exists:
+                    writer.writerow(['date', 'time', 'customer', 'amount', 'invoice'])
+                writer.writerow([
+                    now.strftime('%Y-%m-%d'), 
+                    now.strftime('%H:%M:%S'), 
+                    customer_name, 
+                    total_amount, 
+                    filename
+                ])
             
-    except Exception as e:
-        return jsonify({'success': False, 'message': f'File Error: {e}'}), 500
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'File Error: {e}'}), 500
+
+        # 6. Ship to other branches
+        try:
+            replication.record('sale', {
+                'date': now.strftime('%Y-%m-%d'),
+                'time': now.strftime('%H:%M:%S'),
+                'customer': customer_name,
+                'amount': total_amount,
+                'invoice': filename,
+                'items': [{'id': i['id'], 'name': i['name'], 'qty': i['qty']} for i in invoice_items]
+            })
+        except Exception as e:
+            print(f"Error logging sale for replication: {e}")
 
     return jsonify({'success': True, 'invoice_file': filename, 'total': total_amount})
 
@@ -301,6 +323,7 @@ def manage_product():
             with open(PRODUCT_FILE, 'r', encoding='utf-8') as f:
                 products = list(csv.DictReader(f))
                 
+        changed = None
         fieldnames = ['id', 'name', 'price', 'stock', 'unit', 'type', 'category', 'batch', 'expiry', 'gst_rate', 'per_strip']
         
         if method == 'DELETE':
@@ -312,6 +335,7 @@ def manage_product():
             
             print(f"DEBUG: DELETE ID: {pid}")
             products = [p for p in products if p['id'] != pid]
+            changed = {'op': 'delete', 'id': pid}
             
         elif method == 'POST':
             new_id = str(len(products) + 1)
@@ -332,6 +356,7 @@ def manage_product():
                 'gst_rate': data.get('gst_rate', '0'),
                 'per_strip': data.get('per_strip', '')
             })
+            changed = dict(products[-1], op='upsert')
             
         elif method == 'PUT':
             pid = str(data.get('id'))
@@ -347,6 +372,7 @@ def manage_product():
                     p['expiry'] = data.get('expiry', p.get('expiry', ''))
                     p['gst_rate'] = data.get('gst_rate', p.get('gst_rate', '0'))
                     p['per_strip'] = data.get('per_strip', p.get('per_strip', ''))
+                    changed = dict(p, op='upsert')
                     break
                     
         # Save
@@ -354,6 +380,12 @@ def manage_product():
             writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
             writer.writeheader()
             writer.writerows(products)
+
+        if changed:
+            try:
+                replication.record('product', changed)
+            except Exception as e:
+                print(f"Error logging product change for replication: {e}")
             
         return jsonify({'success': True})
 
@@ -462,74 +494,89 @@ def save_profile():
         if not first_name:
              return jsonify({'success': False, 'message': 'First Name is required'}), 400
 
-        profiles = []
-        if os.path.exists(CUSTOMER_FILE):
-            with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
-                 profiles = list(csv.DictReader(f))
+        # Pulls rewrite customers.csv and sales.csv under the same lock
+        with replication.lock:
+            profiles = []
+            if os.path.exists(CUSTOMER_FILE):
+                with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
+                     profiles = list(csv.DictReader(f))
+            for p in profiles:
+                p['uid'] = replication.customer_uid(p) # Stable across renames and branches
         
-        updated = False
+            updated = False
+            before = None
+            saved = None
         
-        # 1. Try to find by ID
-        if pid:
-            for p in profiles:
-                if p['id'] == pid:
-                    p['first_name'] = first_name
-                    p['last_name'] = last_name
-                    p['mobile'] = mobile
-                    p['address'] = address
-                    updated = True
-                    break
+            # 1. Try to find by ID
+            if pid:
+                for p in profiles:
+                    if p['id'] == pid:
+                        before, saved = dict(p), p
+                        p['first_name'] = first_name
+                        p['last_name'] = last_name
+                        p['mobile'] = mobile
+                        p['address'] = address
+                        updated = True
+                        break
         
-        # 2. If no ID or ID not found (fallback to Name match to prevent duplicates if user didn't have ID yet)
-        if not updated:
-            for p in profiles:
-                if p['first_name'].lower() == first_name.lower() and p['last_name'].lower() == last_name.lower():
-                    p['mobile'] = mobile
-                    p['address'] = address
-                    updated = True
-                    break
+            # 2. If no ID or ID not found (fallback to Name match to prevent duplicates if user didn't have ID yet)
+            if not updated:
+                for p in profiles:
+                    if p['first_name'].lower() == first_name.lower() and p['last_name'].lower() == last_name.lower():
+                        before, saved = dict(p), p
+                        p['mobile'] = mobile
+                        p['address'] = address
+                        updated = True
+                        break
         
-        if not updated:
-            new_id = str(len(profiles) + 1)
-            profiles.append({
-                'id': new_id,
-                'first_name': first_name,
-                'last_name': last_name,
-                'mobile': mobile,
-                'address': address
-            })
+            if not updated:
+                new_id = str(len(profiles) + 1)
+                profiles.append({
+                    'id': new_id,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'mobile': mobile,
+                    'address': address,
+                    'uid': replication.new_customer_uid(first_name, last_name, profiles)
+                })
+                saved = profiles[-1]
             
-        with open(CUSTOMER_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['id','first_name','last_name','mobile','address'])
-            writer.writeheader()
-            writer.writerows(profiles)
+            with open(CUSTOMER_FILE, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=['id','first_name','last_name','mobile','address','uid'])
+                writer.writeheader()
+                writer.writerows(profiles)
             
-        # 3. Handle Historical Name Change (Refactor in sales.csv)
-        old_name = data.get('old_name', '').strip()
-        new_full_name = f"{first_name} {last_name}".strip()
+            # 3. Handle Historical Name Change (Refactor in sales.csv)
+            old_name = data.get('old_name', '').strip()
+            new_full_name = f"{first_name} {last_name}".strip()
         
-        if old_name and old_name != new_full_name:
-            sales_file = os.path.join(BASE_DIR, 'sales.csv')
-            if os.path.exists(sales_file):
-                sales_rows = []
-                sales_updated = False
-                try:
-                    with open(sales_file, 'r', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        sales_rows = list(reader)
+            if old_name and old_name != new_full_name:
+                sales_file = os.path.join(BASE_DIR, 'sales.csv')
+                if os.path.exists(sales_file):
+                    sales_rows = []
+                    sales_updated = False
+                    try:
+                        with open(sales_file, 'r', encoding='utf-8') as f:
+                            reader = csv.reader(f)
+                            sales_rows = list(reader)
                         
-                    # Skip header row 0
-                    for i in range(1, len(sales_rows)):
-                        if len(sales_rows[i]) >= 3 and sales_rows[i][2] == old_name:
-                             sales_rows[i][2] = new_full_name # Update customer column
-                             sales_updated = True
+                        # Skip header row 0
+                        for i in range(1, len(sales_rows)):
+                            if len(sales_rows[i]) >= 3 and sales_rows[i][2] == old_name:
+                                 sales_rows[i][2] = new_full_name # Update customer column
+                                 sales_updated = True
                              
-                    if sales_updated:
-                        with open(sales_file, 'w', newline='', encoding='utf-8') as f:
-                            writer = csv.writer(f)
-                            writer.writerows(sales_rows)
-                except Exception as e:
-                    print(f"Error updating sales log: {e}")
+                        if sales_updated:
+                            with open(sales_file, 'w', newline='', encoding='utf-8') as f:
+                                writer = csv.writer(f)
+                                writer.writerows(sales_rows)
+                    except Exception as e:
+                        print(f"Error updating sales log: {e}")
+
+            try:
+                replication.record_customer(before, saved)
+            except Exception as e:
+                print(f"Error logging customer for replication: {e}")
 
         return jsonify({'success': True})
 
@@ -621,6 +668,25 @@ def print_report_view():
     </html>
     """
     
+@app.route('/api/feed')
+def get_feed():
+    """Ordered mutation log for other branches to pull. ?since=<last seq seen>"""
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', replication.FEED_LIMIT, type=int), replication.FEED_LIMIT)
+    return jsonify(replication.read_feed(since, limit))
+
+@app.route('/api/replicate', methods=['POST'])
+def replicate():
+    """Pull new entries from the branches listed in REPLICATION_PEERS."""
+    return jsonify(replication.pull_all())
+
+@app.route('/api/consolidated')
+def get_consolidated():
+    """Sales and low stock for every branch, kept up to date by replication."""
+    start = request.args.get('start')
+    end = request.args.get('end')
+    return jsonify(replication.consolidated(start, end))
+
 @app.route('/api/reorder_list')
 def get_reorder_list():
     """Generates printable HTML for items with stock <= 10"""
@@ -0,0 +1,501 @@
+"""Multi-branch log shipping for sales, stock and customer profiles.
+
+Every instance appends its mutations (sales, product edits, customer profile
+edits) to an ordered log in replication/log.csv. Each entry keeps the store it
+originated from and that store's own sequence number, so entries can be
+re-shipped through head office without being applied twice.
+
+The log is the only source of truth: on start-up it is replayed to rebuild the
+consolidated per-store totals, the applied versions and the customer profiles.
+Only the per-peer checkpoints are kept separately, in replication/state.json.
+
+Peers pull each other's log through /api/feed. Remote sales and stock changes
+are not written into the local sales.csv / product.csv - they only update the
+consolidated totals. Customer profiles are shared between stores: each profile
+has a stable uid (kept across renames) and every field is settled separately
+by last-writer-wins on (updated_at, store).
+"""
+import csv
+import io
+import json
+import os
+import threading
+import urllib.request
+import uuid
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PRODUCT_FILE = os.path.join(BASE_DIR, 'product', 'product.csv')
+SALES_FILE = os.path.join(BASE_DIR, 'sales.csv')
+CUSTOMER_FILE = os.path.join(BASE_DIR, 'customers.csv')
+REPLICATION_DIR = os.path.join(BASE_DIR, 'replication')
+LOG_FILE = os.path.join(REPLICATION_DIR, 'log.csv')
+STATE_FILE = os.path.join(REPLICATION_DIR, 'state.json')
+
+# Each branch must run with its own STORE_ID, e.g. "main", "branch2"
+STORE_ID = os.environ.get('STORE_ID', 'main')
+# Comma separated base URLs, e.g. "http://192.168.1.20:5000,http://ho:5000"
+PEERS = [p.strip().rstrip('/') for p in os.environ.get('REPLICATION_PEERS', '').split(',') if p.strip()]
+
+LOG_FIELDS = ['seq', 'origin', 'origin_seq', 'timestamp', 'kind', 'payload']
+CUSTOMER_FIELDS = ['id', 'first_name', 'last_name', 'mobile', 'address', 'uid']
+PROFILE_FIELDS = ['first_name', 'last_name', 'mobile', 'address']
+FEED_LIMIT = 500
+
+# Held for every change to the log and for the app's customers.csv / sales.csv
+# writes, since a pull rewrites those files too
+lock = threading.RLock()
+_state = None
+_peers = None
+
+
+class ReplicationError(Exception):
+    """Replication cannot go on without losing or mixing up data."""
+
+
+def _customer_key(first_name, last_name):
+    return f"{first_name} {last_name}".strip().lower()
+
+
+def customer_uid(row):
+    """Stable id of a customers.csv row; older rows fall back to their name."""
+    return row.get('uid') or _customer_key(row.get('first_name', ''), row.get('last_name', ''))
+
+
+def new_customer_uid(first_name, last_name, rows):
+    """uid for a new profile. Same name in two stores means the same customer."""
+    uid = _customer_key(first_name, last_name)
+    if any(customer_uid(r) == uid for r in rows):
+        uid = f"{uid}-{uuid.uuid4().hex[:6]}"
+    return uid
+
+
+def _to_float(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _encode(entry):
+    # json.dumps escapes newlines, so every entry is exactly one line
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(
+        [json.dumps(entry['payload']) if f == 'payload' else entry[f] for f in LOG_FIELDS])
+    return buf.getvalue().encode('utf-8')
+
+
+def _decode(line):
+    row = next(csv.reader([line.decode('utf-8')]))
+    entry = dict(zip(LOG_FIELDS, row))
+    entry['seq'] = int(entry['seq'])
+    entry['origin_seq'] = int(entry['origin_seq'])
+    entry['payload'] = json.loads(entry['payload'])
+    return entry
+
+
+def _empty_state():
+    return {
+        'last_seq': 0,
+        'offsets': [],   # seq - 1 -> byte offset of that entry in log.csv
+        'versions': {},  # origin -> highest origin_seq applied
+        'epochs': {},    # origin -> id of its current log, from its bootstrap
+        'profiles': {},  # customer uid -> {field: [value, [updated_at, origin]]}
+        'sales': {},     # origin -> date -> {amount, orders}
+        'stock': {}      # origin -> product id -> {name, stock}
+    }
+
+
+def _load():
+    """Replay log.csv into memory, bootstrapping it on first use."""
+    global _state, _peers
+    if _state is not None:
+        return
+
+    os.makedirs(REPLICATION_DIR, exist_ok=True)
+    _state = _empty_state()
+    _peers = {}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            _peers = json.load(f)
+
+    if os.path.exists(LOG_FILE):
+        with open(LOG_FILE, 'rb') as f:
+            lines = f.readlines()
+        good = len(lines[0]) if lines and lines[0].endswith(b'\n') else 0
+        for n, line in enumerate(lines[1:] if good else [], start=2):
+            try:
+                entry = _decode(line) if line.endswith(b'\n') else None
+            except (ValueError, StopIteration):
+                entry = None
+            if entry is None or entry['seq'] != _state['last_seq'] + 1:
+                # Only the last line can be torn by a crash mid-write. Anything
+                # earlier is damage; dropping the rest would make us reuse seqs
+                # that peers have already applied.
+                if n < len(lines):
+                    _state = None
+                    raise ReplicationError(
+                        f"{LOG_FILE} is damaged at line {n}; restore it from a backup before starting")
+                break
+            _state['offsets'].append(good)
+            _note(entry)
+            _apply(entry)
+            good += len(line)
+        if good < os.path.getsize(LOG_FILE):
+            with open(LOG_FILE, 'r+b') as f:
+                f.truncate(good)
+
+    if _state['last_seq'] == 0:
+        _state = _empty_state()
+        _bootstrap()
+
+    # Catch up customers.csv with anything applied before a crash
+    _sync_customers(list(_state['profiles']))
+
+
+def init():
+    """Replay (or seed) the log. The app calls this once at start-up, before
+    any request writes to the CSVs the seed snapshot is taken from."""
+    with lock:
+        _load()
+
+
+def _bootstrap():
+    """Start a new log seeded with what this store already has, so peers see
+    existing stock, sales history and customers and not only new changes."""
+    with open(LOG_FILE, 'wb') as f:
+        f.write((','.join(LOG_FIELDS) + '\n').encode('utf-8'))
+
+    products = []
+    if os.path.exists(PRODUCT_FILE):
+        with open(PRODUCT_FILE, 'r', encoding='utf-8') as f:
+            products = [{'id': r['id'], 'name': r['name'], 'stock': _to_float(r.get('stock'))}
+                        for r in csv.DictReader(f)]
+
+    daily_sales = {}
+    if os.path.exists(SALES_FILE):
+        with open(SALES_FILE, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    amt = float(row['amount'])
+                except (ValueError, TypeError, KeyError):
+                    continue
+                day = daily_sales.setdefault(row['date'], {'amount': 0.0, 'orders': 0})
+                day['amount'] += amt
+                day['orders'] += 1
+
+    entries = [_local_entry('bootstrap', {
+        'epoch': uuid.uuid4().hex,
+        'products': products,
+        'sales': daily_sales
+    }, 1)]
+
+    if os.path.exists(CUSTOMER_FILE):
+        with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                entries.append(_local_entry('customer', {
+                    'uid': customer_uid(row),
+                    'fields': {k: row.get(k, '') for k in PROFILE_FIELDS},
+                    'updated_at': ''
+                }, len(entries) + 1))
+
+    _append(entries)
+
+
+def _local_entry(kind, payload, origin_seq=None):
+    return {
+        'origin': STORE_ID,
+        'origin_seq': origin_seq or _state['versions'].get(STORE_ID, 0) + 1,
+        'timestamp': datetime.now().isoformat(),
+        'kind': kind,
+        'payload': payload
+    }
+
+
+def _note(entry):
+    """Advance seq / version bookkeeping for an entry that is in the log."""
+    _state['last_seq'] = entry['seq']
+    _state['versions'][entry['origin']] = entry['origin_seq']
+    if entry['kind'] == 'bootstrap':
+        _state['epochs'][entry['origin']] = entry['payload'].get('epoch', '')
+
+
+def _append(entries):
+    """Number the entries, make them durable in the log, then apply them."""
+    with open(LOG_FILE, 'ab') as f:
+        offset = f.tell()
+        offsets = []
+        for i, entry in enumerate(entries):
+            entry['seq'] = _state['last_seq'] + i + 1
+            line = _encode(entry)
+            offsets.append(offset)
+            offset += len(line)
+            f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+    touched = set()
+    for entry, offset in zip(entries, offsets):
+        _state['offsets'].append(offset)
+        _note(entry)
+        _apply(entry)
+        if entry['kind'] == 'customer':
+            touched.add(entry['payload']['uid'])
+    _sync_customers(touched)
+
+
+def record(kind, payload):
+    """Log a local mutation. Called by the app after the CSV write succeeded."""
+    with lock:
+        _load()
+        entry = _local_entry(kind, payload)
+        _append([entry])
+        return entry['seq']
+
+
+def record_customer(before, after):
+    """Log the profile fields that changed between two customers.csv rows."""
+    fields = {f: after.get(f, '') for f in PROFILE_FIELDS
+              if before is None or before.get(f, '') != after.get(f, '')}
+    if not fields:
+        return None
+    return record('customer', {
+        'uid': after['uid'],
+        'fields': fields,
+        'updated_at': datetime.now().isoformat()
+    })
+
+
+def read_feed(since=0, limit=FEED_LIMIT):
+    """Return log entries with seq > since, oldest first."""
+    with lock:
+        _load()
+        entries = []
+        if since < _state['last_seq']:
+            with open(LOG_FILE, 'rb') as f:
+                f.seek(_state['offsets'][max(since, 0)])
+                for line in f:
+                    entries.append(_decode(line))
+                    if len(entries) >= limit or entries[-1]['seq'] >= _state['last_seq']:
+                        break
+        return {
+            'store': STORE_ID,
+            'epoch': _state['epochs'].get(STORE_ID, ''),
+            'entries': entries,
+            'last_seq': _state['last_seq']
+        }
+
+
+def fetch_feed(peer, since, limit=FEED_LIMIT):
+    """Fetch one batch of a peer's feed over HTTP."""
+    url = f"{peer}/api/feed?since={since}&limit={limit}"
+    with urllib.request.urlopen(url, timeout=30) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def _check_batch(peer, batch, checkpoint, since):
+    store = batch.get('store')
+    if store == STORE_ID:
+        raise ReplicationError(
+            f"{peer} also runs as STORE_ID '{STORE_ID}'; give every branch its own STORE_ID")
+    if checkpoint and (checkpoint['store'] != store or checkpoint['epoch'] != batch.get('epoch')):
+        raise ReplicationError(
+            f"{peer} now serves a different log (store '{store}'); it was reset or replaced")
+    if batch.get('last_seq', 0) < since:
+        raise ReplicationError(
+            f"{peer} log ends at {batch.get('last_seq')} but we already pulled up to {since}; it was reset")
+
+
+def _check_entry(peer, entry, versions):
+    """True if the entry is new. Raises if it would silently drop data."""
+    origin = entry['origin']
+    have = versions.get(origin, 0)
+    if entry['kind'] == 'bootstrap' and origin in _state['epochs'] \
+            and entry['payload'].get('epoch') != _state['epochs'][origin]:
+        raise ReplicationError(f"store '{origin}' (via {peer}) restarted its log; it was reset")
+    if entry['origin_seq'] <= have:
+        return False
+    if origin == STORE_ID:
+        raise ReplicationError(
+            f"{peer} has entries from '{STORE_ID}' that this store never wrote; "
+            f"another branch uses the same STORE_ID or this store was reset")
+    if entry['origin_seq'] != have + 1:
+        raise ReplicationError(
+            f"{peer} skipped entries {have + 1}..{entry['origin_seq'] - 1} of store '{origin}'")
+    return True
+
+
+def pull(peer, fetch=None):
+    """Pull and apply everything new from one peer. Returns entries applied.
+
+    `fetch(since)` returns one feed batch; it defaults to fetch_feed over HTTP.
+    """
+    if fetch is None:
+        fetch = lambda since: fetch_feed(peer, since)
+
+    applied = 0
+    while True:
+        with lock:
+            _load()
+            checkpoint = _peers.get(peer)
+            since = checkpoint['seq'] if checkpoint else 0
+        # Fetch outside the lock so billing is not held up by a slow peer
+        batch = fetch(since)
+        _check_batch(peer, batch, checkpoint, since)
+        entries = batch.get('entries', [])
+        if not entries:
+            break
+        with lock:
+            versions = dict(_state['versions'])
+            new = []
+            for entry in entries:
+                if _check_entry(peer, entry, versions):
+                    versions[entry['origin']] = entry['origin_seq']
+                    new.append({k: entry[k] for k in LOG_FIELDS if k != 'seq'})
+            if new:
+                _append(new)
+                applied += len(new)
+            # Checkpoint only after the entries are durable in our own log
+            _peers[peer] = {'store': batch['store'], 'epoch': batch.get('epoch', ''),
+                            'seq': entries[-1]['seq']}
+            _write_json(STATE_FILE, _peers)
+    return applied
+
+
+def pull_all():
+    """Pull from every peer in REPLICATION_PEERS. Returns {peer: applied or error}."""
+    results = {}
+    for peer in PEERS:
+        try:
+            results[peer] = {'applied': pull(peer)}
+        except Exception as e:
+            results[peer] = {'error': str(e)}
+    return results
+
+
+def _apply(entry):
+    """Fold one log entry into the in-memory consolidated view and profiles."""
+    origin = entry['origin']
+    payload = entry['payload']
+    kind = entry['kind']
+    sales = _state['sales'].setdefault(origin, {})
+    stock = _state['stock'].setdefault(origin, {})
+
+    if kind == 'bootstrap':
+        for p in payload.get('products', []):
+            stock[p['id']] = {'name': p['name'], 'stock': _to_float(p['stock'])}
+        for date, day in payload.get('sales', {}).items():
+            total = sales.setdefault(date, {'amount': 0.0, 'orders': 0})
+            total['amount'] += day['amount']
+            total['orders'] += day['orders']
+
+    elif kind == 'sale':
+        total = sales.setdefault(payload['date'], {'amount': 0.0, 'orders': 0})
+        total['amount'] += _to_float(payload['amount'])
+        total['orders'] += 1
+        for item in payload.get('items', []):
+            prod = stock.setdefault(item['id'], {'name': item.get('name', ''), 'stock': 0.0})
+            prod['stock'] -= _to_float(item['qty'])
+
+    elif kind == 'product':
+        if payload['op'] == 'delete':
+            stock.pop(payload['id'], None)
+        else:
+            stock[payload['id']] = {'name': payload.get('name', ''), 'stock': _to_float(payload.get('stock'))}
+
+    elif kind == 'customer':
+        version = [payload.get('updated_at', ''), origin]
+        profile = _state['profiles'].setdefault(payload['uid'], {})
+        for field, value in payload['fields'].items():
+            if field in PROFILE_FIELDS and (field not in profile or profile[field][1] < version):
+                profile[field] = [value, version]
+
+
+def _sync_customers(uids):
+    """Make the customers.csv rows of these uids match the winning profiles."""
+    if not uids:
+        return
+    rows = []
+    if os.path.exists(CUSTOMER_FILE):
+        with open(CUSTOMER_FILE, 'r', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+    by_uid = {customer_uid(r): r for r in rows}
+
+    dirty = False
+    renames = []
+    for uid in uids:
+        profile = {f: v[0] for f, v in _state['profiles'].get(uid, {}).items()}
+        row = by_uid.get(uid)
+        if row is None:
+            next_id = max([int(r['id']) for r in rows if str(r.get('id', '')).isdigit()] + [0]) + 1
+            row = {'id': str(next_id), 'first_name': '', 'last_name': '', 'mobile': '', 'address': ''}
+            rows.append(row)
+            by_uid[uid] = row
+        old_name = f"{row.get('first_name', '')} {row.get('last_name', '')}".strip()
+        for field in ['uid'] + PROFILE_FIELDS:
+            value = uid if field == 'uid' else profile.get(field, row.get(field, ''))
+            if row.get(field) != value:
+                row[field] = value
+                dirty = True
+        new_name = f"{row['first_name']} {row['last_name']}".strip()
+        if old_name and old_name != new_name:
+            renames.append((old_name, new_name))
+
+    if dirty:
+        with open(CUSTOMER_FILE, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CUSTOMER_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    for old_name, new_name in renames:
+        _rename_sales(old_name, new_name)
+
+
+def _rename_sales(old_name, new_name):
+    """Same as the local profile rename: keep sales history under the new name."""
+    if not os.path.exists(SALES_FILE):
+        return
+    with open(SALES_FILE, 'r', encoding='utf-8') as f:
+        sales_rows = list(csv.reader(f))
+    updated = False
+    for row in sales_rows[1:]:
+        if len(row) >= 3 and row[2] == old_name:
+            row[2] = new_name
+            updated = True
+    if updated:
+        with open(SALES_FILE, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(sales_rows)
+
+
+def consolidated(start=None, end=None, low_stock_limit=10):
+    """Per-store sales totals (optionally for a date range) and low stock."""
+    with lock:
+        _load()
+        stores = []
+        for store in sorted(set(_state['sales']) | set(_state['stock'])):
+            days = _state['sales'].get(store, {})
+            in_range = {d: v for d, v in days.items()
+                        if (not start or d >= start) and (not end or d <= end)}
+            stock = _state['stock'].get(store, {})
+            stores.append({
+                'store': store,
+                'sales': round(sum(v['amount'] for v in in_range.values()), 2),
+                'orders': sum(v['orders'] for v in in_range.values()),
+                'daily': dict(sorted(in_range.items())),
+                'low_stock': [dict(stock[pid], id=pid) for pid in sorted(stock)
+                              if stock[pid]['stock'] < low_stock_limit],
+                'synced_upto': _state['versions'].get(store, 0)
+            })
+        return {
+            'store': STORE_ID,
+            'stores': stores,
+            'total_sales': round(sum(s['sales'] for s in stores), 2),
+            'total_orders': sum(s['orders'] for s in stores),
+            'peers': {p: c['seq'] for p, c in _peers.items()}
+        }
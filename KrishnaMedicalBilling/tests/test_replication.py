@@ -0,0 +1,250 @@
+"""Multi-instance convergence harness for replication.py.
+
+Each branch is a copy of app.py, replication.py and the CSV data in its own
+temp dir, and every command runs in a fresh subprocess with that branch's
+STORE_ID, so nothing is shared between instances except the feeds they pull
+from each other. Sales, product and profile changes go through the real
+routes (Flask test client), in the same order as in production: the app is
+imported, the CSVs are written, then the change is logged.
+
+Run with:  python -m unittest discover -s tests   (or pytest)
+"""
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside one branch dir: python worker.py <store_dir> <store_id> <cmd> <json args>
+WORKER = r'''
+import csv, json, os, subprocess, sys
+store_dir, store_id, cmd, args = sys.argv[1], sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+os.environ['STORE_ID'] = store_id
+sys.path.insert(0, store_dir)
+import app
+import replication
+client = app.app.test_client()
+
+def rows(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+if cmd == 'feed':
+    out = replication.read_feed(args['since'], args.get('limit', 3))
+elif cmd == 'pull':
+    def fetch(since):
+        res = subprocess.run([sys.executable, __file__, args['dir'], args['id'], 'feed',
+                              json.dumps({'since': since})], capture_output=True, text=True, check=True)
+        return json.loads(res.stdout.strip().splitlines()[-1])
+    try:
+        out = {'applied': replication.pull(args['dir'], fetch)}
+    except replication.ReplicationError as e:
+        out = {'error': str(e)}
+elif cmd == 'invoice':
+    out = client.post('/api/invoice', json=args).get_json()
+    out['seq'] = replication._state['last_seq']
+elif cmd == 'product':
+    out = client.open('/api/product', method=args.pop('method'), json=args).get_json()
+elif cmd == 'profile':
+    # Like the customers page: start from the saved row, change some fields
+    row = next((r for r in rows(replication.CUSTOMER_FILE)
+                if replication.customer_uid(r) == args.get('uid')), {})
+    body = {k: row.get(k, '') for k in ['id'] + replication.PROFILE_FIELDS}
+    body.update({k: v for k, v in args.items() if k in replication.PROFILE_FIELDS})
+    if row:
+        body['old_name'] = f"{row['first_name']} {row['last_name']}".strip()
+    out = client.post('/api/customer_profile', json=body).get_json()
+elif cmd == 'dump':
+    view = replication.consolidated()
+    daily = {}
+    for r in rows(replication.SALES_FILE):
+        day = daily.setdefault(r['date'], {'amount': 0.0, 'orders': 0})
+        day['amount'] += float(r['amount'])
+        day['orders'] += 1
+    out = {
+        'stores': view['stores'],
+        'total_sales': view['total_sales'],
+        'total_orders': view['total_orders'],
+        'profiles': replication._state['profiles'],
+        'customers': sorted([r['uid'], r['first_name'], r['last_name'], r['mobile'], r['address']]
+                            for r in rows(replication.CUSTOMER_FILE)),
+        'last_seq': replication._state['last_seq'],
+        # What every branch believes about each store, and what the store's own CSVs say
+        'ledger': {s: {'sales': replication._state['sales'].get(s, {}),
+                       'stock': {pid: p['stock'] for pid, p in replication._state['stock'].get(s, {}).items()}}
+                   for s in replication._state['sales']},
+        'local': {'sales': daily,
+                  'stock': {r['id']: float(r['stock']) for r in rows(replication.PRODUCT_FILE)}},
+    }
+print(json.dumps(out))
+'''
+
+
+def _rounded(ledger):
+    return {
+        'sales': {d: {'amount': round(v['amount'], 2), 'orders': v['orders']} for d, v in ledger['sales'].items()},
+        'stock': ledger['stock']
+    }
+
+
+@unittest.skipUnless(importlib.util.find_spec('flask'), 'flask is not installed')
+class ReplicationHarness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.worker = os.path.join(self.tmp, 'worker.py')
+        with open(self.worker, 'w', encoding='utf-8') as f:
+            f.write(WORKER)
+        self.ids = {}
+        for store in ['a', 'b', 'ho']:
+            self.add_store(store, store)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def add_store(self, name, store_id):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(path, 'product'))
+        for f in ['app.py', 'replication.py', 'sales.csv', 'customers.csv']:
+            shutil.copy(os.path.join(APP_DIR, f), path)
+        shutil.copy(os.path.join(APP_DIR, 'product', 'product.csv'), os.path.join(path, 'product'))
+        self.ids[name] = store_id
+
+    def run_raw(self, store, cmd, **args):
+        return subprocess.run(
+            [sys.executable, self.worker, os.path.join(self.tmp, store), self.ids[store], cmd, json.dumps(args)],
+            capture_output=True, text=True)
+
+    def run_cmd(self, store, cmd, **args):
+        res = self.run_raw(store, cmd, **args)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        return json.loads(res.stdout.strip().splitlines()[-1])
+
+    def invoice(self, store, pid, qty, price, customer='Walk-in'):
+        out = self.run_cmd(store, 'invoice', customer_name=customer,
+                           items=[{'id': pid, 'qty': qty, 'price': price}])
+        self.assertTrue(out['success'], out)
+        return out
+
+    def pull(self, dst, src):
+        return self.run_cmd(dst, 'pull', dir=os.path.join(self.tmp, src), id=self.ids[src])
+
+    def sync(self, stores):
+        for _ in range(2):
+            for dst in stores:
+                for src in stores:
+                    if src != dst:
+                        self.assertNotIn('error', self.pull(dst, src))
+
+    def assert_converged(self, stores):
+        dumps = {s: self.run_cmd(s, 'dump') for s in stores}
+        first = dumps[stores[0]]
+        for store in stores[1:]:
+            for key in ['stores', 'total_sales', 'total_orders', 'profiles', 'customers']:
+                self.assertEqual(dumps[store][key], first[key], f"{key} differs on {store}")
+        # Every branch's view of a store matches that store's own sales.csv / product.csv
+        for store in stores:
+            local = _rounded(dumps[store]['local'])
+            for viewer in stores:
+                self.assertEqual(_rounded(dumps[viewer]['ledger'][self.ids[store]]), local,
+                                 f"{viewer}'s ledger for {store} differs from {store}'s CSVs")
+        return first
+
+    def customer(self, dump, uid):
+        rows = [r for r in dump['customers'] if r[0] == uid]
+        self.assertEqual(len(rows), 1, dump['customers'])
+        return rows[0]
+
+    def test_first_sale_on_fresh_store(self):
+        # No log yet: the seed must be taken before the invoice writes the CSVs
+        self.invoice('a', '1', 2, 50.0)
+        dump = self.assert_converged(['a'])
+        self.assertEqual(dump['ledger']['a']['stock']['1'], dump['local']['stock']['1'])
+
+    def test_converges(self):
+        self.invoice('a', '1', 2, 50.0, customer='X')
+        self.invoice('b', '2', 50, 1.0, customer='Y')
+        self.run_cmd('ho', 'product', method='PUT', id='2', name='Betadine Ointment', stock='3')
+        self.run_cmd('ho', 'product', method='POST', name='New Syrup', price='80', stock='5')
+        # Concurrent edits: a renames Soumen Pasari while b changes his mobile
+        self.run_cmd('a', 'profile', uid='soumen pasari', first_name='Soumen', last_name='Roy')
+        self.run_cmd('b', 'profile', uid='soumen pasari', mobile='999')
+        self.run_cmd('a', 'profile', uid='aakash singh', mobile='111')
+        self.run_cmd('b', 'profile', uid='aakash singh', mobile='222')
+        self.run_cmd('b', 'profile', first_name='New', last_name='Guy', mobile='9')
+
+        self.sync(['a', 'b', 'ho'])
+        dump = self.assert_converged(['a', 'b', 'ho'])
+
+        self.assertEqual(self.customer(dump, 'soumen pasari')[1:], ['Soumen', 'Roy', '999', ''])
+        self.assertEqual(self.customer(dump, 'aakash singh')[3], '222')
+        self.assertEqual(self.customer(dump, 'new guy')[1:3], ['New', 'Guy'])
+        self.assertEqual(dump['ledger']['b']['stock']['2'], 6.0)
+        self.assertEqual(dump['ledger']['ho']['stock']['2'], 3.0)
+
+        # Nothing new: a second pass applies nothing
+        self.assertEqual(self.pull('a', 'b'), {'applied': 0})
+
+    def test_relay_through_head_office(self):
+        self.invoice('a', '1', 1, 10.0)
+        self.pull('ho', 'a')
+        self.pull('b', 'ho')
+        self.pull('b', 'a')  # Same entries again, directly from a
+        self.pull('a', 'ho')
+        self.pull('a', 'b')
+        self.pull('ho', 'b')
+        self.assert_converged(['a', 'b', 'ho'])
+
+    def test_torn_log_line_is_dropped(self):
+        self.pull('a', 'b')
+        before = self.run_cmd('a', 'dump')
+        # Stop half way through writing an entry
+        with open(os.path.join(self.tmp, 'a', 'replication', 'log.csv'), 'ab') as f:
+            f.write(b'99,a,99,2026-10-19T10:00:00,sale,"{""date')
+        self.assertEqual(self.run_cmd('a', 'dump'), before)
+
+        seq = self.invoice('a', '1', 1, 1.0)['seq']
+        self.assertEqual(seq, before['last_seq'] + 1)
+        seqs = [e['seq'] for e in self.run_cmd('a', 'feed', since=0, limit=10000)['entries']]
+        self.assertEqual(seqs, list(range(1, seq + 1)))
+
+        self.sync(['a', 'b'])
+        self.assert_converged(['a', 'b'])
+
+    def test_damaged_log_line_refuses_to_start(self):
+        self.invoice('a', '1', 1, 1.0)
+        log = os.path.join(self.tmp, 'a', 'replication', 'log.csv')
+        with open(log, 'rb') as f:
+            lines = f.readlines()
+        lines[2] = b'garbage\n'
+        with open(log, 'wb') as f:
+            f.writelines(lines)
+        size = os.path.getsize(log)
+
+        res = self.run_raw('a', 'dump')
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn('damaged at line 3', res.stderr)
+        # Later entries must not have been cut off
+        self.assertEqual(os.path.getsize(log), size)
+
+    def test_same_store_id_is_rejected(self):
+        self.add_store('twin', 'a')
+        self.invoice('twin', '1', 1, 1.0)
+        self.assertIn('STORE_ID', self.pull('a', 'twin')['error'])
+        # Relayed through head office it must not be dropped silently either
+        self.pull('ho', 'twin')
+        self.assertIn('error', self.pull('a', 'ho'))
+
+    def test_reset_peer_is_rejected(self):
+        self.pull('a', 'b')
+        shutil.rmtree(os.path.join(self.tmp, 'b', 'replication'))
+        self.assertIn('reset', self.pull('a', 'b')['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()